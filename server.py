@@ -1,20 +1,173 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, send_from_directory
 from flask_cors import CORS
 import cv2
 import numpy as np
+import orjson
 from pyzbar import pyzbar
-import base64
+import pybase64
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 app = Flask(__name__)
 CORS(app)
 
+# Make sure OpenCV dispatches its SIMD-optimized code paths
+cv2.setUseOptimized(True)
+
+# Threads OpenCV may use to parallelize a single filter call. Unset keeps
+# OpenCV's own default, which already follows the available CPUs.
+OPENCV_THREADS = os.getenv("OPENCV_THREADS")
+if OPENCV_THREADS:
+    cv2.setNumThreads(int(OPENCV_THREADS))
+
+# Directory where a copy of every scanned frame is saved, if set
+IMAGES_LOCATION_COPY = os.getenv("IMAGES_LOCATION_COPY")
+if IMAGES_LOCATION_COPY:
+    try:
+        os.makedirs(IMAGES_LOCATION_COPY, exist_ok=True)
+    except OSError as e:
+        print(f"Warning: Failed to create image copy folder: {e}", flush=True)
+
+# Where successful scans redirect to when the client asks for it
+REDIRECT_URL_TEMPLATE = os.getenv(
+    "REDIRECT_URL", "http://localhost/search/{code}"
+)
+
+# Fail fast on placeholders, braces or format specs the redirect cannot
+# fill in, by formatting the template once with sample values
+try:
+    REDIRECT_URL_TEMPLATE.format_map(
+        {"code": "0", "protocol": "http", "host": "localhost"}
+    )
+except (KeyError, IndexError, AttributeError, ValueError) as e:
+    raise ValueError(f"Invalid REDIRECT_URL template: {e!r}") from e
+
+# Locates the start of the image string in a raw /scan request body
+IMAGE_FIELD_PATTERN = re.compile(rb'"image"\s*:\s*"')
+
+# Image copies are written off the request path, one at a time. At most
+# IMAGE_COPY_MAX_PENDING frames wait for the writer; further frames are
+# dropped so a slow disk cannot grow memory without bound.
+image_copy_executor = ThreadPoolExecutor(max_workers=1)
+IMAGE_COPY_MAX_PENDING = int(os.getenv("IMAGE_COPY_MAX_PENDING", 8))
+image_copy_slots = threading.BoundedSemaphore(IMAGE_COPY_MAX_PENDING)
+
+# Sharpening kernel, built once in the float32 type filter2D works in
+SHARPEN_KERNEL = np.array(
+    [[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]], dtype=np.float32
+)
+SHARPEN_KERNEL.setflags(write=False)
+
+# Neighbourhood size of the adaptive threshold's box mean. Larger blocks
+# span whole bars and cost the same, since the mean is a box filter.
+ADAPTIVE_BLOCK_SIZE = int(os.getenv("ADAPTIVE_BLOCK_SIZE", 25))
+if ADAPTIVE_BLOCK_SIZE < 3 or ADAPTIVE_BLOCK_SIZE % 2 == 0:
+    raise ValueError(
+        f"ADAPTIVE_BLOCK_SIZE must be odd and at least 3, "
+        f"got {ADAPTIVE_BLOCK_SIZE}"
+    )
+
+# Frames of at least JPEG_SCALE_MIN_BYTES are decoded at 1/JPEG_SCALE of
+# their size by libjpeg's scaled IDCT (1 always decodes at full size)
+JPEG_SCALE = int(os.getenv("JPEG_SCALE", 1))
+JPEG_SCALE_MIN_BYTES = int(os.getenv("JPEG_SCALE_MIN_BYTES", 262144))
+JPEG_SCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+if JPEG_SCALE not in JPEG_SCALE_FLAGS:
+    raise ValueError(f"JPEG_SCALE must be 1, 2, 4 or 8, got {JPEG_SCALE}")
+
+# Frames are downscaled so their long side is at most this many pixels
+# before scanning (0 disables downscaling)
+MAX_SCAN_DIM = int(os.getenv("MAX_SCAN_DIM", 1280))
+
+# Retry at full resolution when the downscaled frame yields no barcode.
+# Off by default: frames without a barcode would be scanned twice.
+SCAN_FULL_RES_RETRY = os.getenv("SCAN_FULL_RES_RETRY", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Barcode decoders, comma-separated: "pyzbar" (libzbar, default), "zxing"
+# (ZXing-C++) and "opencv" (OpenCV's barcode and WeChat QR detectors).
+# Listing several races them on each image and the first result wins.
+SCANNER_BACKENDS = [
+    name.strip()
+    for name in os.getenv("SCANNER_BACKEND", "pyzbar").lower().split(",")
+    if name.strip()
+]
+if not SCANNER_BACKENDS:
+    raise ValueError("SCANNER_BACKEND must name at least one backend")
+for backend in SCANNER_BACKENDS:
+    if backend not in ("pyzbar", "zxing", "opencv"):
+        raise ValueError(f"Unknown SCANNER_BACKEND: {backend}")
+if "zxing" in SCANNER_BACKENDS:
+    import zxingcpp
+if "opencv" in SCANNER_BACKENDS and not (
+    hasattr(cv2, "barcode") or hasattr(cv2, "wechat_qrcode_WeChatQRCode")
+):
+    print(
+        "Warning: OpenCV has no barcode detectors, skipping opencv backend",
+        flush=True,
+    )
+    SCANNER_BACKENDS = [
+        name for name in SCANNER_BACKENDS if name != "opencv"
+    ] or ["pyzbar"]
+
+# Runs the configured decoders in parallel when there are several
+decoder_executor = ThreadPoolExecutor()
+
 
 def decode_barcode(image):
     """
-    Decode barcodes from an image.
-    Returns the first barcode found or None.
+    Decode barcodes from an image with the configured SCANNER_BACKENDS.
+    Returns the first barcode found, or a result with success False.
+    """
+    if len(SCANNER_BACKENDS) == 1:
+        return SCANNER_DECODERS[SCANNER_BACKENDS[0]](image)
+
+    # The decoders release the GIL, so they genuinely run in parallel
+    futures = {
+        decoder_executor.submit(SCANNER_DECODERS[name], image): name
+        for name in SCANNER_BACKENDS
+    }
+    errors = []
+    try:
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # Log the failing backend and keep waiting for the others
+                print(
+                    f"Warning: {futures[future]} decoder failed: {e}",
+                    flush=True,
+                )
+                errors.append(e)
+                continue
+            if result.get("success"):
+                return result
+    finally:
+        for future in futures:
+            future.cancel()
+
+    # Only fail the request if no backend could scan the image at all
+    if len(errors) == len(futures):
+        raise errors[0]
+
+    return {"success": False}
+
+
+def decode_barcode_pyzbar(image):
+    """
+    Decode barcodes from an image with pyzbar.
+    Returns the first barcode found, or a result with success False.
     """
     # Detect and decode barcodes
     barcodes = pyzbar.decode(image)
@@ -29,6 +182,271 @@ def decode_barcode(image):
     return {"success": False}
 
 
+def decode_barcode_zxing(image):
+    """
+    Decode barcodes from an image with ZXing-C++.
+    Returns the first barcode found, or a result with success False.
+    """
+    # Scan resolution is controlled by MAX_SCAN_DIM and the full-resolution
+    # retry, so ZXing scans the image at the size it is given
+    barcodes = zxingcpp.read_barcodes(
+        image, try_rotate=True, try_downscale=False
+    )
+
+    if barcodes:
+        # Return the first barcode found, typed like pyzbar (e.g. "EAN13")
+        barcode = barcodes[0]
+        barcode_type = barcode.format.name.upper()
+        return {"data": barcode.text, "type": barcode_type, "success": True}
+
+    return {"success": False}
+
+
+class OpenCVDetectors(threading.local):
+    """
+    Per-thread OpenCV barcode and WeChat QR detectors, created on first use
+    so nothing is built at import or in the Gunicorn master before fork.
+    Either is None when this OpenCV build does not ship it.
+    """
+
+    loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.barcode = None
+            self.wechat = None
+            if hasattr(cv2, "barcode"):
+                self.barcode = cv2.barcode.BarcodeDetector()
+            if hasattr(cv2, "wechat_qrcode_WeChatQRCode"):
+                self.wechat = cv2.wechat_qrcode_WeChatQRCode()
+            self.loaded = True
+        return self
+
+
+opencv_detectors = OpenCVDetectors()
+
+
+def decode_barcode_opencv(image):
+    """
+    Decode barcodes from an image with OpenCV's detectors.
+    Returns the first barcode found, or a result with success False.
+    """
+    detectors = opencv_detectors.load()
+
+    if detectors.barcode is not None:
+        _, decoded_info, decoded_types, _ = (
+            detectors.barcode.detectAndDecodeWithType(image)
+        )
+        for barcode_data, barcode_type in zip(decoded_info, decoded_types):
+            if barcode_data:
+                # Type like pyzbar (e.g. "EAN_13" becomes "EAN13")
+                barcode_type = barcode_type.replace("_", "")
+                return {
+                    "data": barcode_data,
+                    "type": barcode_type,
+                    "success": True,
+                }
+
+    if detectors.wechat is not None:
+        decoded_info, _ = detectors.wechat.detectAndDecode(image)
+        for barcode_data in decoded_info:
+            if barcode_data:
+                return {
+                    "data": barcode_data,
+                    "type": "QRCODE",
+                    "success": True,
+                }
+
+    return {"success": False}
+
+
+SCANNER_DECODERS = {
+    "pyzbar": decode_barcode_pyzbar,
+    "zxing": decode_barcode_zxing,
+    "opencv": decode_barcode_opencv,
+}
+
+
+def parse_scan_request(body):
+    """
+    Parse a /scan JSON body without copying the base64 image into a str.
+    Returns the parsed fields and the image payload (a view into body when
+    possible), or None as the payload if there is no image.
+    """
+    match = IMAGE_FIELD_PATTERN.search(body)
+    if match:
+        start = match.end()
+        end = body.find(b'"', start)
+
+        # Base64 never needs JSON escapes; fall back to a full parse if used
+        if end != -1 and body.find(b"\\", start, end) == -1:
+            # Parse the remaining fields with the image emptied out. The
+            # match may be a nested "image" key; only trust it if it was
+            # the top-level one.
+            data = orjson.loads(body[:start] + body[end:])
+            if isinstance(data, dict) and data.get("image") == "":
+                return data, memoryview(body)[start:end]
+
+    data = orjson.loads(body)
+    image = data.get("image") if isinstance(data, dict) else None
+    return data, image
+
+
+def decode_image_payload(image_field):
+    """
+    Decode a base64 image payload, with or without a data URI prefix.
+    Accepts a str or a bytes-like view. Returns the raw image bytes.
+    """
+    if isinstance(image_field, str):
+        image_field = image_field.encode("ascii")
+    view = memoryview(image_field)
+
+    # Strip the "data:image/...;base64," prefix without copying the payload.
+    # Base64 has no commas, so only the short prefix needs searching.
+    separator = view[:128].tobytes().find(b",")
+    view = view[separator + 1 :]
+
+    return pybase64.b64decode(view, validate=False)
+
+
+class FrameBuffers(threading.local):
+    """
+    Per-thread pool of OpenCV output arrays, reused across requests.
+    Arrays are cached per (name, shape, dtype) and allocated on first use.
+    """
+
+    max_arrays = 16
+
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self, name, shape, dtype=np.uint8):
+        key = (name, shape, np.dtype(dtype))
+        array = self.arrays.get(key)
+        if array is None:
+            # Drop stale sizes when clients keep changing resolution
+            if len(self.arrays) >= self.max_arrays:
+                self.arrays.clear()
+            array = self.arrays[key] = np.empty(shape, dtype)
+        return array
+
+
+frame_buffers = FrameBuffers()
+
+
+def downscale_for_scan(gray):
+    """
+    Shrink a frame so its long side is at most MAX_SCAN_DIM pixels.
+    Returns the image unchanged if it is already small enough.
+    """
+    height, width = gray.shape[:2]
+    if not MAX_SCAN_DIM or max(height, width) <= MAX_SCAN_DIM:
+        return gray
+
+    scale = MAX_SCAN_DIM / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(
+        gray,
+        size,
+        dst=frame_buffers.get("resized", (size[1], size[0]), gray.dtype),
+        interpolation=cv2.INTER_AREA,
+    )
+
+
+def find_barcode(images_to_scan):
+    """
+    Scan preprocessed images in order, stopping at the first that decodes.
+    Returns the decode result of that image, or a failed result.
+    """
+    for img_type, processed_image in images_to_scan:
+        result = decode_barcode(processed_image)
+        if result.get("success"):
+            print(f"🎉 Barcode detected using {img_type} image.", flush=True)
+            return result
+
+    return {"success": False}
+
+
+def iter_scan_images(gray):
+    """
+    Yield (name, image) pairs of preprocessed variants to scan, in order.
+    Each variant is computed only when the previous one failed to decode,
+    into this thread's reusable buffers, so it is only valid until the next
+    variant or request.
+    """
+    # The raw grayscale image decodes most readable barcodes on its own
+    yield "gray", gray
+
+    # Apply image preprocessing to improve barcode detection
+    # This is especially helpful for low-quality desktop cameras
+
+    # 1. Apply Gaussian blur to reduce noise
+    blurred = cv2.GaussianBlur(
+        gray, (5, 5), 0, dst=frame_buffers.get("blurred", gray.shape)
+    )
+    yield "blurred", blurred
+
+    # 2. Apply adaptive thresholding to handle varying lighting conditions.
+    # The local mean is a box filter, which already smooths the noise the
+    # blur was removing, so threshold the grayscale image directly.
+    adaptive_thresh = cv2.adaptiveThreshold(
+        gray,
+        255,
+        cv2.ADAPTIVE_THRESH_MEAN_C,
+        cv2.THRESH_BINARY,
+        ADAPTIVE_BLOCK_SIZE,
+        2,
+        dst=frame_buffers.get("adaptive_thresh", gray.shape),
+    )
+    yield "adaptive_thresh", adaptive_thresh
+
+    # 3. Apply sharpening to enhance edges
+    sharpened = cv2.filter2D(
+        gray,
+        -1,
+        SHARPEN_KERNEL,
+        dst=frame_buffers.get("sharpened", gray.shape),
+    )
+    yield "sharpened", sharpened
+
+
+def save_image_copies(image_bytes, gray):
+    """
+    Save the original frame and its variants to IMAGES_LOCATION_COPY.
+    Runs on the background image copy executor, which computes the variants
+    itself so the request only pays for the ones it scans.
+    """
+    try:
+        # Nanosecond timestamps keep filenames unique and cheap to build
+        timestamp = time.time_ns()
+
+        # The original is written as received, without re-encoding it
+        filename = f"scan_{timestamp}_1_original.jpg"
+        with open(os.path.join(IMAGES_LOCATION_COPY, filename), "wb") as f:
+            f.write(image_bytes)
+
+        cnt = 2
+        for img_type, img in iter_scan_images(gray):
+            filename = f"scan_{timestamp}_{cnt}_{img_type}.jpg"
+            filepath = os.path.join(IMAGES_LOCATION_COPY, filename)
+            cv2.imwrite(filepath, img)
+            cnt += 1
+    except Exception as e:
+        # Log error but don't fail the request
+        print(f"Warning: Failed to save image copy: {e}", flush=True)
+    finally:
+        image_copy_slots.release()
+
+
+def ojsonify(obj, status=200):
+    """
+    Build a JSON response with orjson, a faster drop-in for jsonify.
+    """
+    return app.response_class(
+        orjson.dumps(obj), status=status, mimetype="application/json"
+    )
+
+
 @app.route("/")
 def index():
     """Serve the HTML client page"""
@@ -43,113 +461,87 @@ def scan_barcode():
     Optional 'redirect' parameter: if true, redirects to configured URL with barcode.
     """
     try:
-        data = request.get_json()
+        try:
+            data, image = parse_scan_request(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            return ojsonify({"error": "Invalid JSON"}, 400)
 
-        if not data or "image" not in data:
-            return jsonify({"error": "No image data provided"}), 400
+        if not data or image is None:
+            return ojsonify({"error": "No image data provided"}, 400)
 
         # Check if redirect is requested
         should_redirect = data.get("redirect", False)
 
         # Decode base64 image
-        image_data = (
-            data["image"].split(",")[1]
-            if "," in data["image"]
-            else data["image"]
-        )
-        image_bytes = base64.b64decode(image_data)
+        image_bytes = decode_image_payload(image)
 
-        # Convert to numpy array
+        # Convert to numpy array (zero-copy view over the decoded bytes)
         nparr = np.frombuffer(image_bytes, np.uint8)
 
-        # Decode image
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-        if image is None:
-            return jsonify({"error": "Invalid image data"}), 400
-
-        # Convert to grayscale for better barcode detection
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        # Apply image preprocessing to improve barcode detection
-        # This is especially helpful for low-quality desktop cameras
-
-        # 1. Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-
-        # 2. Apply adaptive thresholding to handle varying lighting conditions
-        adaptive_thresh = cv2.adaptiveThreshold(
-            blurred,
-            255,
-            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY,
-            11,
-            2,
+        # Decode image straight to grayscale for better barcode detection;
+        # libjpeg skips the color conversion entirely. Large frames can also
+        # be reduced during decoding, which costs less than a full decode.
+        reduced = JPEG_SCALE > 1 and len(image_bytes) >= JPEG_SCALE_MIN_BYTES
+        gray = cv2.imdecode(
+            nparr,
+            JPEG_SCALE_FLAGS[JPEG_SCALE] if reduced else cv2.IMREAD_GRAYSCALE,
         )
 
-        # 3. Apply sharpening to enhance edges
-        kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
-        sharpened = cv2.filter2D(gray, -1, kernel)
-
-        # Try multiple preprocessing approaches
-        images_to_scan = [
-            ("original", image),
-            ("gray", gray),
-            ("blurred", blurred),
-            ("adaptive_thresh", adaptive_thresh),
-            ("sharpened", sharpened),
-        ]
-
-        # Save image copies if configured
-        images_location = os.getenv("IMAGES_LOCATION_COPY")
-        if images_location:
-            try:
-                import datetime
-
-                os.makedirs(images_location, exist_ok=True)
-                timestamp = datetime.datetime.now().strftime(
-                    "%Y%m%d_%H%M%S_%f"
+        if gray is None:
+            return ojsonify({"error": "Invalid image data"}, 400)
+
+        # Large frames are scanned downscaled; a barcode rarely needs 4K
+        scan_gray = downscale_for_scan(gray)
+
+        # Save image copies if configured. A downscaled frame lives in this
+        # thread's reusable buffers, so it is copied for the background writer.
+        if IMAGES_LOCATION_COPY:
+            if image_copy_slots.acquire(blocking=False):
+                try:
+                    image_copy_executor.submit(
+                        save_image_copies,
+                        image_bytes,
+                        scan_gray if scan_gray is gray else scan_gray.copy(),
+                    )
+                except Exception:
+                    image_copy_slots.release()
+                    raise
+            else:
+                print(
+                    "Warning: Image copy backlog full, skipping frame",
+                    flush=True,
                 )
 
-                cnt = 1
-                for img_type, img in images_to_scan:
-                    filename = f"scan_{timestamp}_{cnt}_{img_type}.jpg"
-                    filepath = os.path.join(images_location, filename)
-                    cv2.imwrite(filepath, img)
-                    cnt += 1
-            except Exception as e:
-                # Log error but don't fail the request
-                print(f"Warning: Failed to save image copy: {e}", flush=True)
-
         # Scan for barcode using multiple preprocessing methods
-        result = {"success": False}
-        for img_type, processed_image in images_to_scan[
-            1:
-        ]:  # Skip original, start from gray
-            result = decode_barcode(processed_image)
-            if result.get("success"):
-                print(f"🎉 Barcode detected using {img_type} image.", flush=True)
-                break
+        result = find_barcode(iter_scan_images(scan_gray))
+
+        # Fall back to the full resolution frame if downscaling lost detail
+        if (
+            not result.get("success")
+            and SCAN_FULL_RES_RETRY
+            and (reduced or scan_gray is not gray)
+        ):
+            if reduced:
+                gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+            result = find_barcode(iter_scan_images(gray))
 
         # If redirect is requested and barcode was success, redirect
         if should_redirect and result.get("success"):
-            redirect_url_template = os.getenv(
-                "REDIRECT_URL", "http://localhost/search/{code}"
-            )
-
             # Replace placeholders with actual values
-            redirect_url = redirect_url_template.replace(
-                "{code}", result["data"]
+            redirect_url = REDIRECT_URL_TEMPLATE.format_map(
+                {
+                    "code": result["data"],
+                    "protocol": request.scheme,
+                    "host": request.host,
+                }
             )
-            redirect_url = redirect_url.replace("{protocol}", request.scheme)
-            redirect_url = redirect_url.replace("{host}", request.host)
 
             return "", 302, {"Location": redirect_url}
 
-        return jsonify(result)
+        return ojsonify(result)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}, 500)
 
 
 @app.route("/health", methods=["GET"])
@@ -160,7 +552,7 @@ def health():
     elapsed = time.time() - start
     if elapsed > 5:
         print(f"⚠️  Health check took {elapsed:.2f}s", flush=True)
-    return jsonify(result)
+    return ojsonify(result)
 
 
 if __name__ == "__main__":
@@ -179,17 +571,34 @@ if __name__ == "__main__":
         print(f"🔗 Redirect URL template set to: {redirect_url}", flush=True)
 
     if is_production:
-        # Production: Use Gunicorn
+        # Production: Use Gunicorn with threaded workers. Decoding releases
+        # the GIL, so requests overlap within a worker; --preload shares the
+        # imported native libraries across the forked workers.
+        # Count the CPUs this process may run on, like nproc, not every
+        # core of the host. sched_getaffinity is Linux-only.
+        cpus = (
+            len(os.sched_getaffinity(0))
+            if hasattr(os, "sched_getaffinity")
+            else os.cpu_count() or 1
+        )
+        workers = os.getenv("GUNICORN_WORKERS", str(cpus))
+        threads = os.getenv("GUNICORN_THREADS", "4")
         print("⚙️  Running with Gunicorn (production mode)", flush=True)
+        print(
+            f"👷 Workers: {workers}, threads per worker: {threads}", flush=True
+        )
         import subprocess
 
         subprocess.run(
             [
                 "gunicorn",
                 "--workers",
-                "2",
+                workers,
                 "--worker-class",
-                "sync",
+                "gthread",
+                "--threads",
+                threads,
+                "--preload",
                 "--timeout",
                 "300",
                 "--graceful-timeout",
@@ -210,4 +619,10 @@ if __name__ == "__main__":
     else:
         # Development: Use Flask development server
         print("⚙️  Running with Flask development server", flush=True)
-        app.run(host="0.0.0.0", port=port, debug=True)
+        app.run(
+            host="0.0.0.0",
+            port=port,
+            debug=True,
+            threaded=True,
+            use_reloader=False,
+        )